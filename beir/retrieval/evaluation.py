@@ -1,7 +1,7 @@
 import pytrec_eval
 import logging
 from typing import List, Dict, Tuple
-from .search.base import BaseSearch
+from .search.base import BaseSearch, RankedResults
 from .custom_metrics import mrr, recall_cap, hole, top_k_accuracy
 
 logger = logging.getLogger(__name__)
@@ -43,14 +43,17 @@ class EvaluateRetrieval:
                  k_values: List[int],
                  ignore_identical_ids: bool=True) -> Tuple[Dict[str, float], Dict[str, float], Dict[str, float], Dict[str, float]]:
         
+        if isinstance(results, RankedResults):
+            # pytrec_eval needs a dict, build it in one pass instead of caching a dict per query in results
+            results = results.to_dict()
+
         if ignore_identical_ids:
             logger.info('For evaluation, we ignore identical query and document ids (default), please explicitly set ``ignore_identical_ids=False`` to ignore this.')
             popped = []
             for qid, rels in results.items():
-                for pid in list(rels):
-                    if qid == pid:
-                        results[qid].pop(pid)
-                        popped.append(pid)
+                if qid in rels:
+                    rels.pop(qid)
+                    popped.append(qid)
 
         ndcg = {}
         _map = {}
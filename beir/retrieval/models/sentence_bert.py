@@ -38,8 +38,6 @@ class SentenceBERT:
         return {'input': input_queue, 'output': output_queue, 'processes': processes}
 
     def stop_multi_process_pool(self, pool: Dict[str, object]):
-        output_queue = pool['output']
-        [output_queue.get() for _ in range(len(pool['processes']))]
         return self.doc_model.stop_multi_process_pool(pool)
 
     def encode_queries(self, queries: List[str], batch_size: int = 16, **kwargs) -> Union[List[Tensor], np.ndarray, Tensor]:
@@ -58,10 +56,6 @@ class SentenceBERT:
             sentences = [(corpus["title"][i] + self.sep + corpus["text"][i]).strip() if "title" in corpus else corpus["text"][i].strip() for i in range(len(corpus['text']))]
         else:
             sentences = [(doc["title"] + self.sep + doc["text"]).strip() if "title" in doc else doc["text"].strip() for doc in corpus]
-        
-        if chunk_id is not None and chunk_id >= len(pool['processes']):
-            output_queue = pool['output']
-            output_queue.get()
 
         input_queue = pool['input']
         input_queue.put([chunk_id, batch_size, sentences])
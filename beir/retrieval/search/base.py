@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
-from typing import Dict
+from collections.abc import MutableMapping
+from typing import Dict, List, Iterator
 
 class BaseSearch(ABC):
 
@@ -9,4 +10,49 @@ class BaseSearch(ABC):
                queries: Dict[str, str], 
                top_k: int, 
                **kwargs) -> Dict[str, Dict[str, float]]:
-        pass
\ No newline at end of file
+        pass
+
+class RankedResults(MutableMapping):
+    """
+    Top-k results of all queries, kept as [num_queries, top_k] (numpy) arrays of corpus ids, scores and hit flags.
+    Behaves like the usual Dict[query_id, Dict[corpus_id, score]], but the dict of a query is only built on first access.
+    Queries can be set or deleted as in a dict. Kept free of dependencies, so that evaluation does not import the dense models.
+    """
+    def __init__(self, query_ids: List[str], corpus_ids, scores, is_hit):
+        self.query_ids = list(query_ids)
+        self.corpus_ids = corpus_ids
+        self.scores = scores
+        self.is_hit = is_hit # False for padding and masked entries
+        self._query_idx = {query_id: idx for idx, query_id in enumerate(self.query_ids)}
+        self._results = {}
+
+    def _build(self, idx: int) -> Dict[str, float]:
+        return {corpus_id: score for corpus_id, score, hit in zip(self.corpus_ids[idx].tolist(), self.scores[idx].tolist(), self.is_hit[idx].tolist()) if hit}
+
+    def __getitem__(self, query_id: str) -> Dict[str, float]:
+        if query_id not in self._results:
+            self._results[query_id] = self._build(self._query_idx[query_id])
+        return self._results[query_id]
+
+    def __setitem__(self, query_id: str, value: Dict[str, float]):
+        self._results[query_id] = value
+        self._query_idx.setdefault(query_id, None) # no row in the arrays, always taken from self._results
+
+    def __delitem__(self, query_id: str):
+        del self._query_idx[query_id]
+        self._results.pop(query_id, None)
+
+    def __contains__(self, query_id: object) -> bool:
+        return query_id in self._query_idx # without building the dict of the query, as Mapping would
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._query_idx)
+
+    def __len__(self) -> int:
+        return len(self._query_idx)
+
+    def to_dict(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns all results as a plain dict, e.g. for pytrec_eval. Dicts of queries not accessed yet are built without caching them.
+        """
+        return {query_id: self._results[query_id] if query_id in self._results else self._build(idx) for query_id, idx in self._query_idx.items()}
@@ -1,5 +1,5 @@
 from .. import BaseSearch
-from .util import cos_sim, dot_score
+from .util import cos_sim, dot_score, topk_tiled
 import logging
 import torch
 from typing import Dict
@@ -11,13 +11,14 @@ logger = logging.getLogger(__name__)
 # Abstract class is BaseSearch
 class DenseRetrievalExactSearch(BaseSearch):
     
-    def __init__(self, model, batch_size: int = 128, corpus_chunk_size: int = 50000, **kwargs):
+    def __init__(self, model, batch_size: int = 128, corpus_chunk_size: int = 50000, tile_size: int = 1024, **kwargs):
         #model is class that provides encode_corpus() and encode_queries()
         self.model = model
         self.batch_size = batch_size
         self.score_functions = {'cos_sim': cos_sim, 'dot': dot_score}
         self.score_function_desc = {'cos_sim': "Cosine Similarity", 'dot': "Dot Product"}
         self.corpus_chunk_size = corpus_chunk_size
+        self.tile_size = tile_size # number of corpus embeddings scored at once against all queries
         self.show_progress_bar = kwargs.get("show_progress_bar", True)
         self.convert_to_tensor = kwargs.get("convert_to_tensor", True)
         self.results = {}
@@ -41,6 +42,10 @@ class DenseRetrievalExactSearch(BaseSearch):
         queries = [queries[qid] for qid in queries]
         query_embeddings = self.model.encode_queries(
             queries, batch_size=self.batch_size, show_progress_bar=self.show_progress_bar, convert_to_tensor=self.convert_to_tensor)
+        query_embeddings = torch.as_tensor(query_embeddings)
+        if score_function == 'cos_sim':
+            # normalize once, so that every tile scores cosine similarity with a plain dot product
+            query_embeddings = torch.nn.functional.normalize(query_embeddings, p=2, dim=1)
           
         logger.info("Sorting Corpus by document length (Longest first)...")
 
@@ -51,6 +56,7 @@ class DenseRetrievalExactSearch(BaseSearch):
         logger.info("Scoring Function: {} ({})".format(self.score_function_desc[score_function], score_function))
 
         itr = range(0, len(corpus), self.corpus_chunk_size)
+        tile_size = max(self.tile_size, 4 * (top_k + 1)) # selecting and merging a tile must stay cheaper than one top-k over the chunk
         
         result_heaps = {qid: [] for qid in query_ids}  # Keep only the top-k docs for each query
         for batch_num, corpus_start_idx in enumerate(itr):
@@ -64,13 +70,18 @@ class DenseRetrievalExactSearch(BaseSearch):
                 show_progress_bar=self.show_progress_bar, 
                 convert_to_tensor = self.convert_to_tensor
                 )
+            sub_corpus_embeddings = torch.as_tensor(sub_corpus_embeddings)
+            if score_function == 'cos_sim':
+                sub_corpus_embeddings = torch.nn.functional.normalize(sub_corpus_embeddings, p=2, dim=1)
 
-            # Compute similarites using either cosine-similarity or dot product
-            cos_scores = self.score_functions[score_function](query_embeddings, sub_corpus_embeddings)
-            cos_scores[torch.isnan(cos_scores)] = -1
-
-            # Get top-k values
-            cos_scores_top_k_values, cos_scores_top_k_idx = torch.topk(cos_scores, min(top_k+1, len(cos_scores[1])), dim=1, largest=True, sorted=return_sorted)
+            # Compute similarites using either cosine-similarity (embeddings normalized above) or dot product and get top-k values,
+            # scoring the corpus chunk tile by tile instead of materializing all query x chunk scores
+            cos_scores_top_k_values, cos_scores_top_k_idx = topk_tiled(
+                lambda start, end: dot_score(query_embeddings, sub_corpus_embeddings[start:end]),
+                len(sub_corpus_embeddings), top_k+1, tile_size=tile_size)
+            if return_sorted:
+                cos_scores_top_k_values, sorted_idx = torch.sort(cos_scores_top_k_values, dim=1, descending=True)
+                cos_scores_top_k_idx = torch.gather(cos_scores_top_k_idx, 1, sorted_idx)
             cos_scores_top_k_values = cos_scores_top_k_values.cpu().tolist()
             cos_scores_top_k_idx = cos_scores_top_k_idx.cpu().tolist()
             
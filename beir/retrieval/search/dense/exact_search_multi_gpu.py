@@ -1,61 +1,49 @@
 from .. import BaseSearch
-from .util import cos_sim, dot_score
+from ..base import RankedResults
+from .util import cos_sim, dot_score, quantize_int8, int8_dot_score, mask_self_matches, merge_topk, topk_tiled
 from sentence_transformers import SentenceTransformer
-from torch.utils.data import DataLoader
-from datasets import Features, Value
-from datasets.utils.filelock import FileLock
-from datasets import Array2D, Dataset
+from datasets import Dataset
 from tqdm.autonotebook import tqdm
-from typing import Dict, List
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 import logging
+import hashlib
 import torch
+import torch.multiprocessing as mp
 import math
 import queue
 import os
 import time
 import numpy as np
+import pyarrow.compute as pc
 
 logger = logging.getLogger(__name__)
 
-import importlib.util
-
-### HuggingFace Evaluate library (pip install evaluate) only available with Python >= 3.7.
-### Hence for no import issues with Python 3.6, we move DummyMetric if ``evaluate`` library is found.
-if importlib.util.find_spec("evaluate") is not None:
-    from evaluate.module import EvaluationModule, EvaluationModuleInfo
-    
-    class DummyMetric(EvaluationModule):
-        len_queries = None
-        
-        def _info(self):
-            return EvaluationModuleInfo(
-                description="dummy metric to handle storing middle results",
-                citation="",
-                features=Features(
-                    {"cos_scores_top_k_values": Array2D((None, self.len_queries), "float32"), "cos_scores_top_k_idx": Array2D((None, self.len_queries), "int32"), "batch_index": Value("int32")},
-                ),
-            )
-
-        def _compute(self, cos_scores_top_k_values, cos_scores_top_k_idx, batch_index):
-            for i in range(len(batch_index) - 1, -1, -1):
-                if batch_index[i] == -1:
-                    del cos_scores_top_k_values[i]
-                    del cos_scores_top_k_idx[i]
-            cos_scores_top_k_values = np.concatenate(cos_scores_top_k_values, axis=0)
-            cos_scores_top_k_idx = np.concatenate(cos_scores_top_k_idx, axis=0)
-            return cos_scores_top_k_values, cos_scores_top_k_idx
-
-        def warmup(self):
-            """
-            Add dummy batch to acquire filelocks for all processes and avoid getting errors
-            """
-            self.add_batch(cos_scores_top_k_values=torch.ones((1, 1, self.len_queries), dtype=torch.float32), cos_scores_top_k_idx=torch.ones((1, 1, self.len_queries), dtype=torch.int32), batch_index=-torch.ones(1, dtype=torch.int32))
+class SearchConfig(NamedTuple):
+    """
+    Settings of one search(), sent to every worker of the (reused) pool at its start. Workers take nothing else from the searcher
+    per search, all other attributes keep the values they had when the pool was started.
+    """
+    query_embeddings: torch.Tensor
+    corpus_query_idx: Optional[torch.Tensor] # index of the query with the same id as each document, or -1
+    top_k_results: Optional[Tuple[torch.Tensor, torch.Tensor]] # result tensors shared by CUDA IPC handles
+    top_k: int
+    score_function: str
+    corpus_chunk_size: int
+    tile_size: int
+    score_memory_fraction: float
+    quantize: bool
+    use_amp: bool
+    corpus_cache_file: Optional[str]
+    corpus_cache_mode: Optional[str]
+    corpus_cache_shape: Optional[Tuple[int, int]]
+    corpus_tokens_dir: Optional[str]
+    corpus_tokens_mode: Optional[str]
 
 #Parent class for any dense model
 class DenseRetrievalParallelExactSearch(BaseSearch):
     
-    def __init__(self, model, batch_size: int = 128, corpus_chunk_size: int = None, target_devices: List[str] = None, **kwargs):
+    def __init__(self, model, batch_size: int = 128, corpus_chunk_size: int = None, target_devices: List[str] = None, tile_size: int = 1024, **kwargs):
         #model is class that provides encode_corpus() and encode_queries()
         self.model = model
         self.batch_size = batch_size
@@ -69,22 +57,43 @@ class DenseRetrievalParallelExactSearch(BaseSearch):
         self.score_functions = {'cos_sim': cos_sim, 'dot': dot_score}
         self.score_function_desc = {'cos_sim': "Cosine Similarity", 'dot': "Dot Product"}
         self.corpus_chunk_size = corpus_chunk_size
+        self.tile_size = tile_size # number of corpus embeddings scored at once against all queries, at least 4 * top_k
         self.show_progress_bar = kwargs.get("show_progress_bar", True)
         self.convert_to_tensor = kwargs.get("convert_to_tensor", True)
+        self.corpus_cache_dir = kwargs.get("corpus_cache_dir", None) # If set, corpus embeddings are cached here as FP16 and reused across search() calls
+        self.model_name = kwargs.get("model_name", None) # Identifies the model in the corpus cache key (default: path of the doc model, keyed with its weights too). For models other than SentenceBERT, clear the cache when their weights change
+        self.quantize = kwargs.get("quantize", False) # If True, query and corpus embeddings are scored as int8 with per-vector scales
+        self.use_amp = kwargs.get("use_amp", False) # If True, CUDA workers encode and score under float16 autocast
+        self.pretokenize = kwargs.get("pretokenize", False) # If True, workers store the token ids of each chunk in corpus_cache_dir, reused by later searches
+        self.score_memory_fraction = kwargs.get("score_memory_fraction", 0.2) # Fraction of free GPU memory the score tiles and top-k of a worker may take
         self.results = {}
 
         self.query_embeddings = {}
         self.top_k = None
         self.score_function = None
         self.sort_corpus = True
-        self.experiment_id = "exact_search_multi_gpu" # f"test_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
+        self.corpus_cache_file = None
+        self.corpus_cache_mode = None # 'r' to score cached embeddings, 'r+' to fill the cache while encoding
+        self.corpus_cache_shape = None
+        self.corpus_tokens_dir = None # one file per chunk, of rows of the number of tokens followed by the token ids of each document
+        self.corpus_tokens_mode = None # 'r' to encode the stored token ids, 'r+' to store them while tokenizing
+        self.pool_barrier = None # lets every worker take exactly one start and one end message per search()
+        self._pool = None # multi-process pool, kept alive across search() calls until close()
+        self._pool_devices = None
+
+        if self.pretokenize and self.corpus_cache_dir is None:
+            raise ValueError("pretokenize requires corpus_cache_dir to store the tokenized corpus")
+        if self.corpus_cache_dir is not None and self.model_name is None:
+            self.model_name = self._model_name_or_path()
+            if self.model_name is None:
+                raise ValueError("model_name must be given to cache corpus embeddings, the model does not tell its name or path")
     
     def search(self, 
                corpus: Dataset, 
                queries: Dataset, 
                top_k: int, 
                score_function: str,
-               **kwargs) -> Dict[str, Dict[str, float]]:
+               **kwargs) -> RankedResults:
         #Create embeddings for all queries using model.encode_queries()
         #Runs semantic search against the corpus embeddings
         #Returns a ranked list with the corpus ids
@@ -92,112 +101,403 @@ class DenseRetrievalParallelExactSearch(BaseSearch):
             raise ValueError("score function: {} must be either (cos_sim) for cosine similarity or (dot) for dot product".format(score_function))
         logger.info("Scoring Function: {} ({})".format(self.score_function_desc[score_function], score_function))
 
-        if importlib.util.find_spec("evaluate") is None:
-            raise ImportError("evaluate library not available. Please do ``pip install evaluate`` library with Python>=3.7 (not available with Python 3.6) to use distributed and multigpu evaluation.")
-            
-        self.corpus_chunk_size = min(math.ceil(len(corpus) / len(self.target_devices) / 10), 5000) if self.corpus_chunk_size is None else self.corpus_chunk_size
-        self.corpus_chunk_size = min(self.corpus_chunk_size, len(corpus)-1) # to avoid getting error in metric.compute()
-        
+        # Scores are computed tile by tile, hence the chunk size only balances the work over the devices (about 10 chunks each)
+        corpus_chunk_size = self.corpus_chunk_size or min(math.ceil(len(corpus) / len(self.target_devices) / 10), 50000)
+        logger.info("Corpus chunk size: {}".format(corpus_chunk_size))
+
         if self.sort_corpus:
             logger.info("Sorting Corpus by document length (Longest first)...")
-            corpus = corpus.map(lambda x: {'len': len(x.get("title", "") + x.get("text", ""))}, num_proc=4)
-            corpus = corpus.sort('len', reverse=True)
-
-        # Initiate dataloader
-        queries_dl = DataLoader(queries, batch_size=self.corpus_chunk_size)
-        corpus_dl = DataLoader(corpus, batch_size=self.corpus_chunk_size)
+            # Lengths computed by Arrow batch by batch, without loading the title and text columns as Python strings
+            arrow_corpus = corpus.with_format("arrow")
+            doc_lengths = np.zeros(len(corpus), dtype=np.int64)
+            for start_idx in range(0, len(corpus), corpus_chunk_size):
+                corpus_batch = arrow_corpus[start_idx:start_idx + corpus_chunk_size] # pyarrow Table
+                for column in ('title', 'text'):
+                    if column in corpus_batch.column_names:
+                        doc_lengths[start_idx:start_idx + len(corpus_batch)] += pc.fill_null(pc.utf8_length(corpus_batch[column]), 0).to_numpy()
+            corpus = corpus.select(np.argsort(-doc_lengths, kind='stable'))
 
         # Encode queries
         logger.info("Encoding Queries in batches...")
         query_embeddings = []
-        for step, queries_batch in enumerate(queries_dl):
-            with torch.no_grad():
+        for start_idx in range(0, len(queries), corpus_chunk_size):
+            queries_batch = queries[start_idx:start_idx + corpus_chunk_size] # Arrow slice, returns a dict of lists
+            with torch.inference_mode():
                 q_embeds = self.model.encode_queries(
                     queries_batch['text'], batch_size=self.batch_size, show_progress_bar=self.show_progress_bar, convert_to_tensor=self.convert_to_tensor)
             query_embeddings.append(q_embeds)
         query_embeddings = torch.cat(query_embeddings, dim=0)
+        if score_function == 'cos_sim':
+            # normalize once, so that the workers score cosine similarity with a plain dot product
+            query_embeddings = torch.nn.functional.normalize(query_embeddings, p=2, dim=1)
 
         # copy the query embeddings to all target devices
         self.query_embeddings = query_embeddings
         self.top_k = top_k
         self.score_function = score_function
 
-        # Start the multi-process pool on all target devices
-        SentenceTransformer._encode_multi_process_worker = self._encode_multi_process_worker
-        pool = self.model.start_multi_process_pool(self.target_devices)
+        query_ids = queries['id']
+        corpus_ids = corpus['id']
+
+        # Look up corpus embeddings cached by a previous search() with the same corpus and model
+        if self.corpus_cache_dir is not None:
+            cache_path = self._corpus_cache_path(corpus_ids, "normalized" if score_function == "cos_sim" else "raw", query_embeddings.shape[1])
+            self.corpus_cache_shape = (len(corpus), query_embeddings.shape[1])
+            # A file of another size was written for other embeddings, it would be read misaligned, hence rebuild it
+            cache_size = self.corpus_cache_shape[0] * self.corpus_cache_shape[1] * np.dtype(np.float16).itemsize
+            cache_hit = os.path.exists(cache_path) and os.path.getsize(cache_path) == cache_size
+            if os.path.exists(cache_path) and not cache_hit:
+                logger.warning("Rebuilding cached corpus embeddings of unexpected size in {}".format(cache_path))
+            if cache_hit:
+                logger.info("Loading cached corpus embeddings from {}".format(cache_path))
+                self.corpus_cache_file, self.corpus_cache_mode = cache_path, 'r'
+            else:
+                os.makedirs(self.corpus_cache_dir, exist_ok=True)
+                self.corpus_cache_file, self.corpus_cache_mode = cache_path + ".tmp", 'r+'
+                np.memmap(self.corpus_cache_file, dtype=np.float16, mode='w+', shape=self.corpus_cache_shape).flush()
+
+        # Token ids of the corpus chunks, stored by the workers of the first search() which has to encode them and reused by later ones
+        if self.pretokenize and self.corpus_cache_mode != 'r':
+            tokens_path = self._corpus_cache_path(corpus_ids, "tokens", self.model.doc_model.get_max_seq_length(), corpus_chunk_size, extension="tokens")
+            if os.path.isdir(tokens_path):
+                logger.info("Loading tokenized corpus from {}".format(tokens_path))
+                self.corpus_tokens_dir, self.corpus_tokens_mode = tokens_path, 'r'
+            else:
+                os.makedirs(tokens_path + ".tmp", exist_ok=True)
+                self.corpus_tokens_dir, self.corpus_tokens_mode = tokens_path + ".tmp", 'r+'
+
+        # Documents with the same id as a query are not retrieved for it, mark them with the index of the query
+        query_idx = {query_id: idx for idx, query_id in enumerate(query_ids)}
+        corpus_query_idx = np.fromiter((query_idx.get(corpus_id, -1) for corpus_id in corpus_ids), dtype=np.int64, count=len(corpus_ids))
+        corpus_query_idx = torch.from_numpy(corpus_query_idx) if (corpus_query_idx >= 0).any() else None
 
-        logger.info("Encoding Corpus in batches... Warning: This might take a while!")
-        start_time = time.time()
-        for chunk_id, corpus_batch in tqdm(enumerate(corpus_dl), total=len(corpus) // self.corpus_chunk_size):
-            with torch.no_grad():
-                self.model.encode_corpus_parallel(
-                    corpus_batch, pool=pool, batch_size=self.batch_size, chunk_id=chunk_id)
+        # On CUDA, workers write their top-k directly into these tensors on the first device (shared by CUDA IPC handles)
+        top_k_results = None
+        device = self.target_devices[0]
+        if torch.device(device).type == 'cuda':
+            num_processes = len(self.target_devices)
+            top_k_results = (torch.full((num_processes, len(query_embeddings), top_k), -float("inf"), device=device),
+                             torch.full((num_processes, len(query_embeddings), top_k), -1, dtype=torch.int64, device=device))
+
+        # Settings of this search, sent to every worker as they were started with an earlier state of self
+        search_config = SearchConfig(
+            query_embeddings=query_embeddings.cpu(), corpus_query_idx=corpus_query_idx, top_k_results=top_k_results, top_k=top_k, score_function=score_function,
+            corpus_chunk_size=corpus_chunk_size, tile_size=self.tile_size, score_memory_fraction=self.score_memory_fraction, quantize=self.quantize, use_amp=self.use_amp,
+            corpus_cache_file=self.corpus_cache_file, corpus_cache_mode=self.corpus_cache_mode, corpus_cache_shape=self.corpus_cache_shape,
+            corpus_tokens_dir=self.corpus_tokens_dir, corpus_tokens_mode=self.corpus_tokens_mode)
+
+        # Start the multi-process pool on all target devices, or reuse the one of the previous search
+        pool = self._get_pool()
+        num_processes = len(pool['processes'])
+        try:
+            for _ in range(num_processes):
+                pool['input'].put(search_config)
+
+            start_time = time.time()
+            num_chunks = math.ceil(len(corpus) / corpus_chunk_size)
+            if self.corpus_cache_mode == 'r':
+                # Skip encoding, the workers read the cached embeddings of each chunk for scoring only
+                logger.info("Scoring cached Corpus embeddings in batches...")
+            elif self.corpus_tokens_mode == 'r':
+                # The workers read the token ids of each chunk and only run the forward pass of the model
+                logger.info("Encoding pretokenized Corpus in batches... Warning: This might take a while!")
+            else:
+                logger.info("Encoding Corpus in batches... Warning: This might take a while!")
 
-        # Stop the proccesses in the pool and free memory
-        self.model.stop_multi_process_pool(pool)
+            # Keep two chunks per worker queued (longest first), idle workers pull the next one and every finished
+            # chunk queues another, so that the text of at most 2 * num_processes chunks is held in the queue at once
+            num_queued = min(num_chunks, 2 * num_processes)
+            for chunk_id in range(num_queued):
+                self._queue_chunk(pool, corpus, chunk_id, corpus_chunk_size)
+            for _ in tqdm(range(num_chunks)):
+                pool['output'].get()
+                if num_queued < num_chunks:
+                    self._queue_chunk(pool, corpus, num_queued, corpus_chunk_size)
+                    num_queued += 1
+
+            # Signal the end of the corpus, so that every worker sends back its top-k
+            for _ in range(num_processes):
+                pool['input'].put(None)
+            worker_results = [pool['output'].get() for _ in range(num_processes)]
+        except BaseException:
+            # Workers may be left in the middle of this search, do not reuse them
+            self.close()
+            raise
+
+        if self.corpus_cache_mode == 'r+':
+            os.replace(self.corpus_cache_file, cache_path)
+            logger.info("Cached corpus embeddings to {}".format(cache_path))
+        self.corpus_cache_file, self.corpus_cache_mode = None, None
+        if self.corpus_tokens_mode == 'r+':
+            os.replace(self.corpus_tokens_dir, tokens_path)
+            logger.info("Cached tokenized corpus to {}".format(tokens_path))
+        self.corpus_tokens_dir, self.corpus_tokens_mode = None, None
 
         end_time = time.time()
         logger.info("Encoded all batches in {:.2f} seconds".format(end_time - start_time))
 
-        # Gather all results
-        DummyMetric.len_queries = len(queries)
-        metric = DummyMetric(experiment_id=self.experiment_id, num_process=len(self.target_devices), process_id=0)
-        metric.filelock = FileLock(os.path.join(metric.data_dir, f"{metric.experiment_id}-{metric.num_process}-{metric.process_id}.arrow.lock"))
-        metric.cache_file_name = os.path.join(metric.data_dir, f"{metric.experiment_id}-{metric.num_process}-{metric.process_id}.arrow")
+        # Gather all results, shape: [num_queries, num_processes * top_k]
+        if top_k_results is not None:
+            cos_scores_top_k_values = top_k_results[0].permute(1, 0, 2).reshape(len(query_embeddings), -1)
+            cos_scores_top_k_idx = top_k_results[1].permute(1, 0, 2).reshape(len(query_embeddings), -1)
+        else:
+            cos_scores_top_k_values = torch.from_numpy(np.concatenate([values for values, _ in worker_results], axis=1)).to(device)
+            cos_scores_top_k_idx = torch.from_numpy(np.concatenate([idx for _, idx in worker_results], axis=1)).to(device)
 
-        cos_scores_top_k_values, cos_scores_top_k_idx = metric.compute()
-
-        # sort similar docs for each query by cosine similarity and keep only top_k
-        sorted_idx = np.argsort(cos_scores_top_k_values, axis=0)[::-1]
-        sorted_idx = sorted_idx[:self.top_k+1]
-        cos_scores_top_k_values = np.take_along_axis(cos_scores_top_k_values, sorted_idx, axis=0)
-        cos_scores_top_k_idx = np.take_along_axis(cos_scores_top_k_idx, sorted_idx, axis=0)
+        # keep only the top_k most similar docs of all workers for each query, ranked by score
+        cos_scores_top_k_values, top_k_pos = torch.topk(cos_scores_top_k_values, self.top_k, dim=1, largest=True, sorted=True)
+        cos_scores_top_k_idx = torch.gather(cos_scores_top_k_idx, 1, top_k_pos)
+        cos_scores_top_k_values, cos_scores_top_k_idx = cos_scores_top_k_values.cpu().numpy(), cos_scores_top_k_idx.cpu().numpy()
 
         logger.info("Formatting results...")
-        # Load corpus ids in memory
-        query_ids = queries['id']
-        corpus_ids = corpus['id']
-        self.results = {qid: {} for qid in query_ids}
-        for query_itr in tqdm(range(len(query_embeddings))):
-            query_id = query_ids[query_itr]
-            for i in range(len(cos_scores_top_k_values)):
-                sub_corpus_id = cos_scores_top_k_idx[i][query_itr]
-                score = cos_scores_top_k_values[i][query_itr].item() # convert np.float to float
-                corpus_id = corpus_ids[sub_corpus_id]
-                if corpus_id != query_id:
-                    self.results[query_id][corpus_id] = score
+        corpus_ids = np.asarray(corpus_ids, dtype=object)
+        is_hit = (cos_scores_top_k_idx >= 0) & (cos_scores_top_k_values > -np.inf) # corpora with fewer than top_k documents leave padding or masked entries
+        top_k_corpus_ids = corpus_ids[np.where(is_hit, cos_scores_top_k_idx, 0)]
+        self.results = RankedResults(query_ids, top_k_corpus_ids, cos_scores_top_k_values, is_hit)
         return self.results 
 
+    def close(self):
+        """
+        Stops the multi-process pool kept alive across search() calls and frees its memory.
+        """
+        if self._pool is not None:
+            self.model.stop_multi_process_pool(self._pool)
+            self._pool, self._pool_devices = None, None
+
+    def _queue_chunk(self, pool: Dict[str, object], corpus: Dataset, chunk_id: int, corpus_chunk_size: int):
+        """
+        Queues a corpus chunk for the workers, as its text if it has to be encoded, else as its id only.
+        """
+        if self.corpus_cache_mode == 'r' or self.corpus_tokens_mode == 'r':
+            pool['input'].put([chunk_id, self.batch_size, None])
+        else:
+            corpus_batch = corpus[chunk_id * corpus_chunk_size:(chunk_id + 1) * corpus_chunk_size] # Arrow slice, returns a dict of lists
+            self.model.encode_corpus_parallel(corpus_batch, pool=pool, batch_size=self.batch_size, chunk_id=chunk_id)
+
+    def _max_tile_size(self, config: SearchConfig, num_queries: int, device: str) -> int:
+        """
+        Returns the widest score tile for which the [num_queries, tile] scores, plus the running, tile and merged top-k
+        values and indices, fit in score_memory_fraction of the free memory of the (CUDA) device.
+        """
+        score_bytes = 12 if config.quantize else (2 if config.use_amp else 4) # int8 scores pass through int32 and two float32 buffers
+        top_k_bytes = 4 * num_queries * config.top_k * (4 + 8) # the merge concatenates two top-k, hence twice as wide
+        budget = config.score_memory_fraction * torch.cuda.mem_get_info(device)[0] - top_k_bytes
+        return max(1, int(budget / (max(num_queries, 1) * score_bytes)))
+
+    def _get_pool(self) -> Dict[str, object]:
+        """
+        Returns the multi-process pool, starting it on the first call or when the target devices changed.
+        """
+        if self._pool is not None and self._pool_devices != list(self.target_devices):
+            self.close()
+        if self._pool is None:
+            self.pool_barrier = mp.get_context('spawn').Barrier(len(self.target_devices))
+            SentenceTransformer._encode_multi_process_worker = self._encode_multi_process_worker
+            self._pool = self.model.start_multi_process_pool(self.target_devices)
+            self._pool_devices = list(self.target_devices)
+        return self._pool
+
+    @staticmethod
+    def _encode_tokens(model: SentenceTransformer, tokens: np.ndarray, device: str, batch_size: int) -> torch.Tensor:
+        """
+        Encodes a chunk of the pretokenized corpus (rows of the number of tokens followed by the token ids) with the forward pass
+        of the model, in batches trimmed to their longest document. The attention mask is rebuilt from the number of tokens.
+        """
+        model.to(device)
+        token_type_ids = 'token_type_ids' in model.tokenizer.model_input_names # single sentences only have type 0
+        embeddings = []
+        for start_idx in range(0, len(tokens), batch_size):
+            batch = np.array(tokens[start_idx:start_idx + batch_size])
+            seq_length = int(batch[:, 0].max())
+            input_ids = torch.from_numpy(batch[:, 1:1 + seq_length]).to(device=device, dtype=torch.long)
+            lengths = torch.from_numpy(batch[:, 0]).to(device)
+            features = {'input_ids': input_ids, 'attention_mask': (torch.arange(seq_length, device=device).unsqueeze(0) < lengths.unsqueeze(1)).long()}
+            if token_type_ids:
+                features['token_type_ids'] = torch.zeros_like(input_ids)
+            embeddings.append(model(features)['sentence_embedding'])
+        return torch.cat(embeddings, dim=0)
+
+    @staticmethod
+    def _tokenize(model: SentenceTransformer, sentences: List[str]) -> np.ndarray:
+        """
+        Tokenizes a corpus chunk into rows of the number of tokens followed by the token ids, padded to its longest document.
+        """
+        features = model.tokenize(sentences)
+        lengths = features['attention_mask'].sum(dim=1, keepdim=True)
+        return torch.cat([lengths, features['input_ids']], dim=1).numpy().astype(np.int32)
+
+    def _model_name_or_path(self) -> str:
+        """
+        Returns the name or path the doc model of a SentenceBERT model was loaded from, or None for other models.
+        """
+        doc_model = getattr(self.model, 'doc_model', None)
+        if not isinstance(doc_model, SentenceTransformer) or len(doc_model) == 0:
+            return None
+        config = getattr(getattr(doc_model[0], 'auto_model', None), 'config', None)
+        return getattr(config, '_name_or_path', None) or None
+
+    def _weights_fingerprint(self) -> str:
+        """
+        Returns a cheap fingerprint of the weights of the doc model of a SentenceBERT model (the first values of every parameter),
+        so that a checkpoint saved again to the same path does not get the embeddings of the previous one. None for other models.
+        """
+        doc_model = getattr(self.model, 'doc_model', None)
+        if not isinstance(doc_model, SentenceTransformer):
+            return None
+        fingerprint = hashlib.sha256()
+        for param in doc_model.parameters():
+            fingerprint.update(param.detach().flatten()[:64].float().cpu().numpy().tobytes())
+        return fingerprint.hexdigest()
+
+    def _corpus_cache_path(self, corpus_ids: List[str], *settings, extension: str = "fp16") -> str:
+        """
+        Returns a cache file for the corpus, keyed by a fingerprint of the (sorted) corpus ids, the model and the settings of
+        what is cached, e.g. embeddings for cosine similarity are stored L2-normalized, hence separately from dot product ones.
+        """
+        fingerprint = hashlib.sha256()
+        for setting in (self.model_name, self._weights_fingerprint()) + settings:
+            fingerprint.update("{}\0".format(setting).encode("utf-8"))
+        for corpus_id in corpus_ids:
+            fingerprint.update(corpus_id.encode("utf-8") + b"\0")
+        return os.path.join(self.corpus_cache_dir, "corpus-{}.{}".format(fingerprint.hexdigest()[:32], extension))
+
     def _encode_multi_process_worker(self, process_id, device, model, input_queue, results_queue):
         """
         (taken from UKPLab/sentence-transformers/sentence_transformers/SentenceTransformer.py)
         Internal working process to encode sentences in multi-process setup.
         Note: Added distributed similarity computing and finding top k similar docs.
         """
-        DummyMetric.len_queries = len(self.query_embeddings)
-        metric = DummyMetric(experiment_id=self.experiment_id, num_process=len(self.target_devices), process_id=process_id)
-        metric.warmup()
-        with torch.no_grad():
+        # Encode the next chunk on one CUDA stream while the previous chunk is scored on another
+        encode_stream, score_stream = None, None
+        if torch.device(device).type == 'cuda':
+            encode_stream, score_stream = torch.cuda.Stream(device), torch.cuda.Stream(device)
+
+        with torch.inference_mode():
             while True:
                 try:
-                    id, batch_size, sentences = input_queue.get()
-                    corpus_embeds = model.encode(
-                        sentences, device=device, show_progress_bar=False, convert_to_tensor=True, batch_size=batch_size
-                    ).detach()
+                    message = input_queue.get()
+                    if isinstance(message, SearchConfig):
+                        # Start of a search, take over its settings
+                        config = message
+                        corpus_cache = None
+                        if config.corpus_cache_file is not None:
+                            corpus_cache = np.memmap(config.corpus_cache_file, dtype=np.float16, mode=config.corpus_cache_mode, shape=config.corpus_cache_shape)
+
+                        # Copy the query embeddings to the worker device once instead of once per chunk
+                        query_embeds = config.query_embeddings
+                        if torch.device(device).type == 'cuda':
+                            query_embeds = query_embeds.pin_memory()
+                        query_embeds = query_embeds.to(device, non_blocking=True)
+                        if config.quantize:
+                            query_int8, query_scale = quantize_int8(query_embeds)
+
+                        # Running top-k over all chunks processed by this worker, kept on the device
+                        top_k_values = torch.full((len(query_embeds), config.top_k), -float("inf"), device=device)
+                        top_k_idx = torch.full((len(query_embeds), config.top_k), -1, dtype=torch.int64, device=device)
+
+                        # Tiles of a few multiples of top_k, so that selecting and merging each tile stays cheaper than one top-k over the chunk
+                        min_tile_size = 4 * config.top_k
+                        tile_size = max(config.tile_size, min_tile_size)
+                        if torch.device(device).type == 'cuda':
+                            # Measured on the device of this worker, after the query embeddings and top-k were allocated
+                            max_tile_size = self._max_tile_size(config, len(query_embeds), device)
+                            if max_tile_size < min_tile_size:
+                                logger.warning("Score tiles of {} documents (4 * top_k) exceed score_memory_fraction {} of the free memory of {}, "
+                                               "scoring with them anyway".format(min_tile_size, config.score_memory_fraction, device))
+                            tile_size = max(min(tile_size, max_tile_size), min_tile_size)
+
+                        if score_stream is not None:
+                            score_stream.wait_stream(torch.cuda.current_stream(device))
+                        event = None # marks the end of scoring the previous chunk
+
+                        # float16 autocast for encoding and float scoring (int8 scores would overflow float16)
+                        use_amp = config.use_amp and torch.device(device).type == 'cuda'
+
+                        # Wait for all workers, so that none of them takes a second start message
+                        self.pool_barrier.wait()
+                        continue
+
+                    if message is None:
+                        # End of the corpus, send back the top-k of all chunks processed by this worker at once
+                        if score_stream is not None:
+                            score_stream.synchronize()
+                        if config.top_k_results is not None:
+                            # Copy device to device into the result tensors of the main process, no host staging
+                            config.top_k_results[0][process_id].copy_(top_k_values)
+                            config.top_k_results[1][process_id].copy_(top_k_idx)
+                            torch.cuda.synchronize(device)
+                            torch.cuda.synchronize(config.top_k_results[0].device)
+                            results_queue.put(None)
+                        else:
+                            results_queue.put((top_k_values.cpu().numpy(), top_k_idx.cpu().numpy()))
+                        corpus_cache, query_embeds, top_k_values, top_k_idx = None, None, None, None
+                        config = None # holds the only reference to the CUDA IPC handles, released before the next search
+
+                        # Wait for all workers, so that none of them takes a second end message
+                        self.pool_barrier.wait()
+                        continue
+
+                    id, batch_size, sentences = message
+
+                    with torch.cuda.stream(encode_stream), torch.autocast('cuda', dtype=torch.float16, enabled=use_amp):
+                        if config.corpus_cache_mode == 'r':
+                            # Cached corpus embeddings (already normalized for cosine similarity), no need to encode
+                            cached_embeds = np.array(corpus_cache[id * config.corpus_chunk_size:(id + 1) * config.corpus_chunk_size])
+                            corpus_embeds = torch.from_numpy(cached_embeds).to(device=device, dtype=query_embeds.dtype)
+                        else:
+                            if config.corpus_tokens_mode is not None:
+                                # Pretokenized corpus chunk, tokenized and stored by this worker if not stored yet
+                                tokens_file = os.path.join(config.corpus_tokens_dir, "{}.npy".format(id))
+                                if config.corpus_tokens_mode == 'r':
+                                    tokens = np.load(tokens_file)
+                                else:
+                                    tokens = self._tokenize(model, sentences)
+                                    np.save(tokens_file, tokens)
+                                corpus_embeds = self._encode_tokens(model, tokens, device, batch_size)
+                            else:
+                                corpus_embeds = model.encode(
+                                    sentences, device=device, show_progress_bar=False, convert_to_tensor=True, batch_size=batch_size
+                                ).detach()
+                            if config.score_function == 'cos_sim':
+                                corpus_embeds = torch.nn.functional.normalize(corpus_embeds, p=2, dim=1, out=corpus_embeds)
+
+                        if config.corpus_cache_mode == 'r+':
+                            corpus_cache[id * config.corpus_chunk_size:id * config.corpus_chunk_size + len(corpus_embeds)] = corpus_embeds.half().cpu().numpy()
+                            corpus_cache.flush()
+
+                    if score_stream is not None:
+                        # Keep at most one chunk in flight on the scoring stream
+                        if event is not None:
+                            event.synchronize()
+                        score_stream.wait_stream(encode_stream)
+                        corpus_embeds.record_stream(score_stream)
+
+                    with torch.cuda.stream(score_stream), torch.autocast('cuda', dtype=torch.float16, enabled=use_amp and not config.quantize):
+                        # Embeddings are normalized for cosine similarity, hence both score functions are a dot product
+                        if config.quantize:
+                            corpus_int8, corpus_scale = quantize_int8(corpus_embeds)
+                            score_chunk = lambda start, end: int8_dot_score(query_int8, query_scale, corpus_int8[start:end], corpus_scale[start:end])
+                        else:
+                            score_chunk = lambda start, end: torch.mm(query_embeds, corpus_embeds[start:end].transpose(0, 1))
+                        if config.corpus_query_idx is not None:
+                            # Copied on the scoring stream, so that the masking never reads it before the copy landed
+                            chunk_query_idx = config.corpus_query_idx[id * config.corpus_chunk_size:(id + 1) * config.corpus_chunk_size].to(device, non_blocking=True)
+                            score_tile = lambda start, end: mask_self_matches(score_chunk(start, end), chunk_query_idx[start:end])
+                        else:
+                            score_tile = score_chunk
 
-                    cos_scores = self.score_functions[self.score_function](self.query_embeddings.to(corpus_embeds.device), corpus_embeds).detach()
-                    cos_scores[torch.isnan(cos_scores)] = -1
+                        #Get top-k values, scoring the corpus chunk tile by tile
+                        cos_scores_top_k_values, cos_scores_top_k_idx = topk_tiled(score_tile, len(corpus_embeds), config.top_k, tile_size=tile_size)
 
-                    #Get top-k values
-                    cos_scores_top_k_values, cos_scores_top_k_idx = torch.topk(cos_scores, min(self.top_k+1, len(cos_scores[1])), dim=1, largest=True, sorted=False)
-                    cos_scores_top_k_values = cos_scores_top_k_values.T.unsqueeze(0).detach()
-                    cos_scores_top_k_idx = cos_scores_top_k_idx.T.unsqueeze(0).detach()
+                        # correct sentence ids
+                        cos_scores_top_k_idx += id * config.corpus_chunk_size
 
-                    # correct sentence ids
-                    cos_scores_top_k_idx += id * self.corpus_chunk_size
+                        # Merge into the running top-k of this worker
+                        top_k_values, top_k_idx = merge_topk(top_k_values, top_k_idx, cos_scores_top_k_values, cos_scores_top_k_idx, config.top_k)
 
-                    # Store results in an Apache Arrow table
-                    metric.add_batch(cos_scores_top_k_values=cos_scores_top_k_values, cos_scores_top_k_idx=cos_scores_top_k_idx, batch_index=[id]*len(cos_scores_top_k_values))
+                        if score_stream is not None:
+                            event = torch.cuda.Event()
+                            event.record(score_stream)
 
                     # Alarm that process finished processing a batch
                     results_queue.put(None)
@@ -1,6 +1,7 @@
 import torch
 import numpy as np
 import csv
+from typing import Callable, Tuple
 
 def cos_sim(a: torch.Tensor, b: torch.Tensor):
     """
@@ -42,6 +43,65 @@ def dot_score(a: torch.Tensor, b: torch.Tensor):
 
     return torch.mm(a, b.transpose(0, 1))
 
+def quantize_int8(a: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Symmetrically quantizes each row of a to int8 with its own scale (amax / 127).
+    :return: Tuple (int8 tensor, float32 scale per row) with a ~= int8 tensor * scale[:, None]
+    """
+    a = a.float()
+    scale = a.abs().amax(dim=1).clamp(min=1e-12) / 127
+    return torch.round(a / scale.unsqueeze(1)).to(torch.int8), scale
+
+def int8_dot_score(a: torch.Tensor, a_scale: torch.Tensor, b: torch.Tensor, b_scale: torch.Tensor) -> torch.Tensor:
+    """
+    Computes the dot-product dot_prod(a[i], b[j]) for all i and j of int8 quantized embeddings (see quantize_int8).
+    Uses the int8 GEMM (torch._int_mm) on CUDA when the shapes allow it, else a float matmul over the int8 values.
+    :return: Matrix with res[i][j]  = dot_prod(a[i], b[j]) * a_scale[i] * b_scale[j]
+    """
+    if a.is_cuda and hasattr(torch, "_int_mm") and a.shape[0] > 16 and a.shape[1] % 8 == 0 and b.shape[0] % 8 == 0:
+        scores = torch._int_mm(a, b.transpose(0, 1)).float()
+    else:
+        scores = torch.mm(a.float(), b.float().transpose(0, 1))
+    return scores * a_scale.unsqueeze(1) * b_scale.unsqueeze(0)
+
+def mask_self_matches(scores: torch.Tensor, query_idx: torch.Tensor) -> torch.Tensor:
+    """
+    Sets scores[query_idx[j]][j] to -inf (in-place) for all columns j with query_idx[j] >= 0, i.e. documents which are a query themselves.
+    Uses a single scatter into row 0 for unmatched columns (writing back their own score), hence never synchronizes with the host.
+    :return: The masked scores
+    """
+    src = torch.where(query_idx >= 0, torch.full_like(scores[0], -float("inf")), scores[0])
+    return scores.scatter_(0, query_idx.clamp(min=0).unsqueeze(0), src.unsqueeze(0))
+
+def merge_topk(values: torch.Tensor, indices: torch.Tensor, new_values: torch.Tensor, new_indices: torch.Tensor, k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Merges two (values, indices) candidate sets row-wise and keeps the k largest values per row.
+    :return: Tuple (values, indices) each of shape [num_rows, min(k, num_candidates)], unsorted
+    """
+    values = torch.cat([values, new_values], dim=1)
+    indices = torch.cat([indices, new_indices], dim=1)
+    values, pos = torch.topk(values, min(k, values.shape[1]), dim=1, largest=True, sorted=False)
+    return values, torch.gather(indices, 1, pos)
+
+def topk_tiled(score_tile: Callable[[int, int], torch.Tensor], num_docs: int, k: int, tile_size: int = 1024) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Computes the top-k scores per row by streaming score_tile(start, end) over column tiles of [0, num_docs)
+    and merging each tile into a running top-k, so the full [num_rows, num_docs] score matrix is never materialized.
+    :return: Tuple (values, indices) each of shape [num_rows, min(k, num_docs)], unsorted
+    """
+    values, indices = None, None
+    for start in range(0, num_docs, tile_size):
+        end = min(start + tile_size, num_docs)
+        scores = score_tile(start, end)
+        scores = torch.nan_to_num_(scores, nan=-1.0, posinf=float("inf"), neginf=-float("inf")) # single pass, keeps masked -inf scores
+        tile_values, tile_indices = torch.topk(scores, min(k, end - start), dim=1, largest=True, sorted=False)
+        tile_indices += start
+        if values is None:
+            values, indices = tile_values, tile_indices
+        else:
+            values, indices = merge_topk(values, indices, tile_values, tile_indices, k)
+    return values, indices
+
 def normalize(a: np.ndarray) -> np.ndarray:
     return a/np.linalg.norm(a, ord=2, axis=1, keepdims=True)
 
@@ -53,8 +53,8 @@ if __name__ == "__main__":
     end_time = time.time()
     print("Time taken to retrieve: {:.2f} seconds".format(end_time - start_time))
 
-    #### Optional: Stop the proccesses in the pool
-    # beir_model.doc_model.stop_multi_process_pool(pool)
+    #### The worker processes are kept alive for further retrieve() calls, stop them when done
+    model.close()
 
     #### Evaluate your retrieval using NDCG@k, MAP@K ...
 
@@ -1,14 +1,7 @@
 '''
 This sample python shows how to evaluate BEIR dataset quickly using Mutliple GPU for evaluation (for large datasets).
-To run this code, you need Python >= 3.7 (not 3.6) and need to install evaluate library separately: ``pip install evaluate``
 Enabling multi-gpu evaluation has been thanks due to tremendous efforts of Noumane Tazi (https://github.com/NouamaneTazi)
 
-IMPORTANT: The following code will not run with Python 3.6! 
-1. Please install Python 3.7 using Anaconda (conda create -n myenv python=3.7)
-2. Next, install Evaluate (https://github.com/huggingface/evaluate) using ``pip install evaluate``.
-
-You are good to go!
-
 To run this code, you preferably need access to mutliple GPUs. Faster than running on single GPU.
 CUDA_VISIBLE_DEVICES=0,1,2,3 python evaluate_sbert_multi_gpu.py
 '''
@@ -61,6 +54,9 @@ if __name__ == "__main__":
     start_time = time.time()
     results = retriever.retrieve(corpus, queries)
     end_time = time.time()
+
+    #### The worker processes are kept alive for further retrieve() calls, stop them when done
+    model.close()
     print("Time taken to retrieve: {:.2f} seconds".format(end_time - start_time))
 
     #### Evaluate your retrieval using NDCG@k, MAP@K ...